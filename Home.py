@@ -3,19 +3,25 @@ import cv2
 import numpy as np
 import os
 import streamlit as st
-from llama_index import SimpleDirectoryReader
 from pydantic_llm import (
-    pydantic_llm,
     DamagedParts,
     damages_initial_prompt_str,
-    ConditionsReport,
     conditions_report_initial_prompt_str,
 )
 import pandas as pd
 from llama_index.multi_modal_llms.openai import OpenAIMultiModal
-from car_colorizer import process_car_parts
+from car_colorizer import image_slots_map
+from pipeline import (
+    encoders,
+    resolutions,
+    side_outputs,
+    image_digest,
+    changed_slots,
+    slots_sides,
+    sides_parts,
+    submit_events,
+)
 import requests
-from io import BytesIO
 from streamlit_modal import Modal
 import streamlit.components.v1 as components
 
@@ -37,7 +43,18 @@ def create_report(data={"test": "123"}):
 load_dotenv()
 
 
-states_names = ["front_image", "back_image", "left_image", "right_image", "report_id"]
+states_names = [
+    "front_image",
+    "back_image",
+    "left_image",
+    "right_image",
+    "report_id",
+    "image_digests",
+    "conditions_report",
+    "car_selection",
+    "image_outputs",
+    "encoding_stats",
+]
 
 openai_mm_llm = OpenAIMultiModal(model="gpt-4-vision-preview")
 
@@ -84,11 +101,11 @@ col1, col2 = st.columns(2)
 
 with col1:
     create_drag_and_drop("front_image", "Front Image")
-    create_drag_and_drop("right_image", "Left Image")
+    create_drag_and_drop("right_image", "Right Image")
 
 with col2:
     create_drag_and_drop("back_image", "Back Image")
-    create_drag_and_drop("left_image", "Right Image")
+    create_drag_and_drop("left_image", "Left Image")
 
 
 def save_image(state_name):
@@ -130,56 +147,125 @@ with st.form(key="car_form"):
         ("Gemini", "OpenAI"),
     )
 
+    selected_encoder = st.selectbox(
+        "Select image encoder",
+        list(encoders),
+    )
+
+    selected_sizes = st.multiselect(
+        "Select extra image sizes",
+        [resolution for resolution in resolutions if resolution != "full"],
+    )
+
     submit_button = st.form_submit_button(label="Submit")
 
 if submit_button:
-    with st.spinner("Processing..."):
-        for state_name in states_names:
+    car_selection = (
+        selected_make,
+        selected_model,
+        selected_year,
+        selected_llm_model,
+    )
+    outputs = side_outputs(selected_encoder, ["full"] + selected_sizes)
+    digests = {
+        state_name: image_digest(st.session_state[state_name])
+        for state_name in image_slots_map
+    }
+    previous_conditions = st.session_state["conditions_report"]
+
+    # Only re-evaluate the uploads that changed since the last submit
+    incremental = (
+        previous_conditions is not None
+        and st.session_state["car_selection"] == car_selection
+    )
+    slots = list(image_slots_map)
+    if incremental:
+        slots = changed_slots(digests, st.session_state["image_digests"])
+        # A removed image can't be re-scored on its own
+        incremental = all(digests[slot] is not None for slot in slots)
+    if not incremental:
+        slots = list(image_slots_map)
+
+    # Keys in a new encoder or size were never written for the previous report
+    outputs_changed = st.session_state["image_outputs"] != outputs
+
+    if incremental and not slots and not outputs_changed:
+        # Nothing changed, the previous report is still valid
+        modal.open()
+    else:
+        for state_name in slots:
             save_image(state_name)
         path = os.path.join(os.getcwd(), "images")
 
-        image_documents = SimpleDirectoryReader(path).load_data()
+        import boto3
+
+        s3 = boto3.resource("s3")
 
-        conditions_report_response = pydantic_llm(
-            output_class=ConditionsReport,
-            image_documents=image_documents,
+        events = submit_events(
+            s3,
+            create_report,
+            image_files=[
+                os.path.join(path, f"{state_name}.jpg")
+                for state_name in slots
+                if digests[state_name] is not None
+            ],
             prompt_template_str=conditions_report_initial_prompt_str.format(
-                make_name=selected_make, model_name=selected_model, year=selected_year
+                make_name=selected_make,
+                model_name=selected_model,
+                year=selected_year,
             ),
             selected_llm_model=selected_llm_model,
+            car_name=f"{selected_make} {selected_model} {selected_year}",
+            previous_conditions=previous_conditions if incremental else None,
+            previous_report_id=(
+                st.session_state["report_id"]
+                if incremental and not outputs_changed
+                else None
+            ),
+            rescored_parts=sides_parts(slots_sides(slots)),
+            outputs=outputs,
         )
 
-        for state_name in states_names:
-            delete_image(state_name)
-
-        request_data = []
-
-        for part, condition in dict(conditions_report_response).items():
-            request_data.append({"part": part, "condition": condition})
-
-        id = create_report(
-            data={
-                "conditions_report": request_data,
-                "car_name": f"{selected_make} {selected_model} {selected_year}",
-            }
-        )
+        # Colored sides are shown as soon as they are rendered
+        side_columns = dict(zip(image_slots_map.values(), st.columns(4)))
+        encoding_stats = []
+
+        # Remove the saved uploads even if the LLM or the reader fails
+        try:
+            with st.status("Processing...", expanded=True) as status:
+                for event, data in events:
+                    if event == "images_prepared":
+                        status.write(
+                            f"{len(data['image_documents'])} image(s) prepared"
+                        )
+                    elif event == "llm_started":
+                        status.update(label=f"Waiting for {data['llm_model']}...")
+                    elif event == "conditions_report":
+                        conditions = data["conditions"]
+                        status.update(label="Rendering sides...")
+                    elif event == "side_rendered":
+                        side_columns[data["side"]].image(
+                            data["image"], caption=data["side"].title()
+                        )
+                    elif event == "report_created":
+                        id = data["report_id"]
+                        status.update(label="Uploading images...")
+                    elif event == "side_uploaded":
+                        encoding_stats.append(data)
+                        status.write(f"Uploaded {data['key']}")
+                    elif event == "side_copied":
+                        status.write(f"Kept the previous {data['side']} image")
+                status.update(label="Done", state="complete")
+        finally:
+            for state_name in slots:
+                delete_image(state_name)
 
         st.session_state["report_id"] = id
-
-        car_sides = ["front", "back", "left", "right"]
-        import boto3
-
-        s3 = boto3.resource("s3")
-
-        for side in car_sides:
-            colored_side = process_car_parts(dict(conditions_report_response), side)
-            in_memory_file = BytesIO()
-            colored_side.save(in_memory_file, format="PNG")
-            in_memory_file.seek(0)
-            s3.Bucket("elastic-llm").put_object(
-                Key=f"{id}/colored_car_{side}.png",
-                Body=in_memory_file,
-            )
+        st.session_state["image_digests"] = digests
+        st.session_state["conditions_report"] = conditions
+        st.session_state["car_selection"] = car_selection
+        st.session_state["image_outputs"] = outputs
+        st.session_state["encoding_stats"] = encoding_stats
 
         modal.open()
 
@@ -199,6 +285,10 @@ if modal.is_open():
         """
         components.html(html_string, height=350)
 
+        if st.session_state["encoding_stats"]:
+            st.subheader("Image encoding")
+            st.dataframe(pd.DataFrame.from_records(st.session_state["encoding_stats"]))
+
         # st.subheader("Summary")
         # st.write(damages_response.summary)
 
@@ -65,6 +65,15 @@ sides_map = {
     },
 }
 
+# Upload slot that shows each side of the car
+
+image_slots_map = {
+    "front_image": "front",
+    "back_image": "back",
+    "left_image": "left",
+    "right_image": "right",
+}
+
 
 def colorize(image, condition):
     color = color_map.get(condition, "gray")
@@ -1,7 +1,5 @@
-from car_colorizer import process_car_parts
+from car_colorizer import sides_map
 from dotenv import load_dotenv
-from io import BytesIO
-from llama_index import SimpleDirectoryReader
 from llama_index.multi_modal_llms.openai import OpenAIMultiModal
 from streamlit_modal import Modal
 import cv2
@@ -9,11 +7,8 @@ import os
 import requests
 import streamlit as st
 import streamlit.components.v1 as components
-from pydantic_llm import (
-    pydantic_llm,
-    ConditionsReport,
-    conditions_report_initial_prompt_str,
-)
+from pipeline import submit_events
+from pydantic_llm import conditions_report_initial_prompt_str
 
 modal = Modal("Damage Report", key="demo", max_width=1280)
 
@@ -94,48 +89,41 @@ with st.form(key="car_form"):
     submit_button = st.form_submit_button(label="Submit")
 
 if submit_button:
-    with st.spinner("Processing..."):
-        image_documents = SimpleDirectoryReader(images_directory).load_data()
-
-        conditions_report_response = pydantic_llm(
-            output_class=ConditionsReport,
-            image_documents=image_documents,
-            prompt_template_str=conditions_report_initial_prompt_str.format(
-                make_name=selected_make, model_name=selected_model, year=selected_year
-            ),
-            selected_llm_model=selected_llm_model,
-        )
-
-        request_data = []
-
-        for part, condition in dict(conditions_report_response).items():
-            request_data.append({"part": part, "condition": condition})
-
-        id = create_report(
-            data={
-                "conditions_report": request_data,
-                "car_name": f"{selected_make} {selected_model} {selected_year}",
-            }
-        )
-
-        st.session_state["report_id"] = id
-
-        car_sides = ["front", "back", "left", "right"]
-        import boto3
-
-        s3 = boto3.resource("s3")
-
-        for side in car_sides:
-            colored_side = process_car_parts(dict(conditions_report_response), side)
-            in_memory_file = BytesIO()
-            colored_side.save(in_memory_file, format="PNG")
-            in_memory_file.seek(0)
-            s3.Bucket("elastic-llm").put_object(
-                Key=f"{id}/colored_car_{side}.png",
-                Body=in_memory_file,
-            )
+    import boto3
+
+    s3 = boto3.resource("s3")
+
+    events = submit_events(
+        s3,
+        create_report,
+        image_files=[
+            os.path.join(images_directory, image_name)
+            for image_name in sorted(os.listdir(images_directory))
+            if image_name.lower().endswith((".jpg", ".jpeg", ".png"))
+        ],
+        prompt_template_str=conditions_report_initial_prompt_str.format(
+            make_name=selected_make, model_name=selected_model, year=selected_year
+        ),
+        selected_llm_model=selected_llm_model,
+        car_name=f"{selected_make} {selected_model} {selected_year}",
+    )
 
-        modal.open()
+    side_columns = dict(zip(sides_map, st.columns(4)))
+
+    with st.status("Processing...", expanded=True) as status:
+        for event, data in events:
+            if event == "llm_started":
+                status.update(label=f"Waiting for {data['llm_model']}...")
+            elif event == "side_rendered":
+                side_columns[data["side"]].image(
+                    data["image"], caption=data["side"].title()
+                )
+            elif event == "report_created":
+                st.session_state["report_id"] = data["report_id"]
+                status.update(label="Uploading images...")
+        status.update(label="Done", state="complete")
+
+    modal.open()
 
 if modal.is_open():
     with modal.container():
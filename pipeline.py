@@ -0,0 +1,291 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from PIL import Image
+from llama_index import SimpleDirectoryReader
+from car_colorizer import process_car_parts, sides_map, image_slots_map
+from pydantic_llm import pydantic_llm, ConditionsReport
+
+bucket_name = "elastic-llm"
+
+# The report page loads the full size PNG keys, other encoders and sizes
+# are stored next to them (see side_outputs).
+
+encoders = {
+    "PNG": {
+        "format": "PNG",
+        "extension": "png",
+        "content_type": "image/png",
+        "options": {},
+    },
+    "PNG fast": {
+        "format": "PNG",
+        "extension": "png",
+        "content_type": "image/png",
+        "options": {"compress_level": 1},
+    },
+    # The renders only use a few flat colors from color_map
+    "PNG palette": {
+        "format": "PNG",
+        "extension": "png",
+        "content_type": "image/png",
+        "options": {"optimize": True},
+        "palette": True,
+    },
+    "WebP lossless": {
+        "format": "WEBP",
+        "extension": "webp",
+        "content_type": "image/webp",
+        "options": {"lossless": True},
+    },
+}
+
+# Max width/height in pixels, None keeps the rendered size
+
+resolutions = {
+    "full": None,
+    "thumbnail": 320,
+}
+
+# Dependency chain used to re-evaluate only what a changed upload touches:
+# image slot -> side -> parts (sides_map) and side -> S3 key.
+
+
+def image_digest(uploaded_file):
+    if uploaded_file is None:
+        return None
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+def changed_slots(digests, previous_digests):
+    return [
+        slot
+        for slot in image_slots_map
+        if digests.get(slot) != previous_digests.get(slot)
+    ]
+
+
+def slots_sides(slots):
+    return [image_slots_map[slot] for slot in slots]
+
+
+def sides_parts(sides):
+    return [part for side in sides for part in sides_map[side]["parts"]]
+
+
+def parts_sides(parts):
+    return [
+        side
+        for side in sides_map
+        if any(part in parts for part in sides_map[side]["parts"])
+    ]
+
+
+def changed_sides(previous_conditions, conditions):
+    return parts_sides(
+        [
+            part
+            for part, condition in conditions.items()
+            if previous_conditions.get(part) != condition
+        ]
+    )
+
+
+def side_s3_key(report_id, side, encoder="PNG", resolution="full"):
+    suffix = "" if resolution == "full" else f"_{resolution}"
+    extension = encoders[encoder]["extension"]
+    return f"{report_id}/colored_car_{side}{suffix}.{extension}"
+
+
+def side_outputs(encoder="PNG", sizes=("full",)):
+    """(encoder, resolution) pairs uploaded for every side.
+
+    The full size PNG needed by the report page always comes first, it is
+    encoded with the selected encoder when that one writes PNG.
+    """
+
+    report_encoder = encoder if encoders[encoder]["extension"] == "png" else "PNG"
+    outputs = [(report_encoder, "full")]
+    for resolution in sizes:
+        if (encoder, resolution) not in outputs:
+            outputs.append((encoder, resolution))
+    return outputs
+
+
+def merge_conditions(previous_conditions, new_conditions, parts):
+    conditions = dict(previous_conditions)
+    for part in parts:
+        conditions[part] = new_conditions[part]
+    return conditions
+
+
+def encode_side(colored_side, encoder="PNG", resolution="full"):
+    start = time.perf_counter()
+    image = colored_side
+    max_size = resolutions[resolution]
+    if max_size is not None:
+        image = colored_side.copy()
+        image.thumbnail((max_size, max_size))
+    if encoders[encoder].get("palette"):
+        image = image.quantize(method=Image.Quantize.FASTOCTREE)
+    in_memory_file = BytesIO()
+    image.save(
+        in_memory_file,
+        format=encoders[encoder]["format"],
+        **encoders[encoder]["options"],
+    )
+    in_memory_file.seek(0)
+    return in_memory_file, time.perf_counter() - start
+
+
+def render_side(conditions, side, outputs):
+    colored_side = process_car_parts(conditions, side)
+    return colored_side, {
+        (encoder, resolution): encode_side(colored_side, encoder, resolution)
+        for encoder, resolution in outputs
+    }
+
+
+def upload_side(s3, key, in_memory_file, encoder="PNG"):
+    s3.Bucket(bucket_name).put_object(
+        Key=key,
+        Body=in_memory_file,
+        ContentType=encoders[encoder]["content_type"],
+    )
+
+
+def copy_side(s3, previous_report_id, report_id, side, outputs):
+    # Server side copy, the image is neither rendered nor uploaded again
+    for encoder, resolution in outputs:
+        s3.Object(
+            bucket_name, side_s3_key(report_id, side, encoder, resolution)
+        ).copy_from(
+            CopySource={
+                "Bucket": bucket_name,
+                "Key": side_s3_key(previous_report_id, side, encoder, resolution),
+            }
+        )
+
+
+def render_sides_events(conditions, sides, outputs):
+    # Sides are rendered and encoded in parallel and yielded as they finish
+    with ThreadPoolExecutor(max_workers=len(sides_map)) as executor:
+        futures = {
+            executor.submit(render_side, conditions, side, outputs): side
+            for side in sides
+        }
+        for future in as_completed(futures):
+            colored_side, encoded = future.result()
+            yield "side_rendered", {
+                "side": futures[future],
+                "image": colored_side,
+                "encoded": encoded,
+            }
+
+
+def upload_sides_events(
+    s3,
+    report_id,
+    rendered_sides,
+    outputs,
+    previous_report_id=None,
+):
+    for side in sides_map:
+        if side in rendered_sides:
+            encoded = rendered_sides[side]
+            for (encoder, resolution), (in_memory_file, seconds) in encoded.items():
+                key = side_s3_key(report_id, side, encoder, resolution)
+                upload_side(s3, key, in_memory_file, encoder)
+                yield "side_uploaded", {
+                    "side": side,
+                    "key": key,
+                    "encoder": encoder,
+                    "resolution": resolution,
+                    "size_kb": round(in_memory_file.getbuffer().nbytes / 1024, 1),
+                    "encoding_ms": round(seconds * 1000, 1),
+                }
+        elif previous_report_id is not None:
+            copy_side(s3, previous_report_id, report_id, side, outputs)
+            yield "side_copied", {"side": side}
+
+
+def submit_events(
+    s3,
+    create_report,
+    image_files,
+    prompt_template_str,
+    selected_llm_model,
+    car_name,
+    previous_conditions=None,
+    previous_report_id=None,
+    rescored_parts=None,
+    outputs=None,
+):
+    """Run the submit pipeline, yielding an (event, data) tuple after each step.
+
+    Events, in order: images_prepared, llm_started, conditions_report,
+    side_rendered (one per rendered side), report_created and side_uploaded
+    or side_copied (one per side). The report is created while the sides are
+    rendered, so they can be shown before the report and uploads finish.
+
+    With previous_conditions only rescored_parts are taken from the LLM
+    response, and the LLM is skipped when there are no image_files. With
+    previous_report_id only the sides whose conditions changed are rendered,
+    the rest are copied from that report, so its keys must match outputs.
+    """
+
+    if outputs is None:
+        outputs = side_outputs()
+
+    if image_files:
+        image_documents = SimpleDirectoryReader(input_files=image_files).load_data()
+        yield "images_prepared", {"image_documents": image_documents}
+
+        yield "llm_started", {"llm_model": selected_llm_model}
+        conditions_report_response = pydantic_llm(
+            output_class=ConditionsReport,
+            image_documents=image_documents,
+            prompt_template_str=prompt_template_str,
+            selected_llm_model=selected_llm_model,
+        )
+        conditions = dict(conditions_report_response)
+    else:
+        conditions = dict(previous_conditions)
+
+    if previous_conditions is not None:
+        conditions = merge_conditions(previous_conditions, conditions, rescored_parts)
+
+    sides = list(sides_map)
+    if previous_report_id is not None:
+        sides = changed_sides(previous_conditions, conditions)
+
+    yield "conditions_report", {"conditions": conditions}
+
+    request_data = []
+
+    for part, condition in conditions.items():
+        request_data.append({"part": part, "condition": condition})
+
+    # The report only needs the conditions, its id is only needed for uploads
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        report_future = executor.submit(
+            create_report,
+            data={
+                "conditions_report": request_data,
+                "car_name": car_name,
+            },
+        )
+
+        rendered_sides = {}
+        for event, data in render_sides_events(conditions, sides, outputs):
+            rendered_sides[data["side"]] = data["encoded"]
+            yield event, data
+
+        report_id = report_future.result()
+
+    yield "report_created", {"report_id": report_id}
+
+    yield from upload_sides_events(
+        s3, report_id, rendered_sides, outputs, previous_report_id
+    )